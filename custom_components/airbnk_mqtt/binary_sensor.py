@@ -53,6 +53,10 @@ class AirbnkBinarySensor(BinarySensorEntity):
         # Sensors should also register callbacks to HA when their state changes
         self._device.register_callback(self.async_write_ha_state)
 
+    async def async_will_remove_from_hass(self):
+        """Run when this Entity will be removed from HA."""
+        self._device.unregister_callback(self.async_write_ha_state)
+
     @property
     def available(self):
         """Return if entity is available or not."""
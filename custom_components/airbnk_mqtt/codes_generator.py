@@ -1,12 +1,15 @@
 from __future__ import annotations
-import base64
-import binascii
 import hashlib
+import hmac
 import logging
 import time
 
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+from Crypto.Cipher import AES
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -19,12 +22,11 @@ class AESCipher:
     def __init__(self, key):
         """Initialize a new AESCipher."""
         self.block_size = 16
-        self.cipher = Cipher(algorithms.AES(key), modes.ECB(), default_backend())
+        self._aes = AES.new(key, AES.MODE_ECB)
 
     def encrypt(self, raw, use_base64=True):
         """Encrypt data to be sent to device."""
-        encryptor = self.cipher.encryptor()
-        crypted_text = encryptor.update(self._pad(raw)) + encryptor.finalize()
+        crypted_text = self._aes.encrypt(self._pad(raw))
         return base64.b64encode(crypted_text) if use_base64 else crypted_text
 
     def decrypt(self, enc, use_base64=True):
@@ -32,8 +34,18 @@ class AESCipher:
         if use_base64:
             enc = base64.b64decode(enc)
 
-        decryptor = self.cipher.decryptor()
-        return self._unpad(decryptor.update(enc) + decryptor.finalize())
+        return self._unpad(self._aes.decrypt(enc))
+
+    def encrypt_block16(self, block):
+        """Encrypt a single 16-byte block without padding."""
+        return self._aes.encrypt(block)
+
+    def decrypt_chunks(self, enc, chunk_size):
+        """Decrypt data in one call and unpad each chunk_size chunk."""
+        dec = self._aes.decrypt(enc)
+        return [
+            self._unpad(dec[i : i + chunk_size]) for i in range(0, len(dec), chunk_size)
+        ]
 
     def _pad(self, data):
         padnum = self.block_size - len(data) % self.block_size
@@ -44,75 +56,26 @@ class AESCipher:
         return data[: -ord(data[len(data) - 1 :])]
 
 
-def XOR64Buffer(arr, value):
-    for i in range(0, 64):
-        arr[i] ^= value
-    return arr
-
-
 def generateWorkingKey(arr, i):
-    arr2 = bytearray(72)
-    arr2[0 : len(arr)] = arr
-    arr2 = XOR64Buffer(arr2, 0x36)
-    arr2[71] = i & 0xFF
-    i = i >> 8
-    arr2[70] = i & 0xFF
-    i = i >> 8
-    arr2[69] = i & 0xFF
-    i = i >> 8
-    arr2[68] = i & 0xFF
-    arr2sha1 = hashlib.sha1(arr2).digest()
-    arr3 = bytearray(84)
-    arr3[0 : len(arr)] = arr
-    arr3 = XOR64Buffer(arr3, 0x5C)
-    arr3[64:84] = arr2sha1
-    arr3sha1 = hashlib.sha1(arr3).digest()
-    return arr3sha1
+    counter = (i & 0xFFFFFFFF).to_bytes(8, "big")
+    return hmac.new(bytes(arr[0:64]), counter, hashlib.sha1).digest()
 
 
 def generatePswV2(arr):
-    arr2 = bytearray(8)
-    for i in range(0, 4):
-        b = arr[i + 16]
-        i2 = i * 2
-        arr2[i2] = arr[(b >> 4) & 15]
-        arr2[i2 + 1] = arr[b & 15]
-    return arr2
+    return bytearray(arr[n] for b in arr[16:20] for n in (b >> 4, b & 15))
 
 
 def generateSignatureV2(key, i, arr):
-    lenArr = len(arr)
-    arr2 = bytearray(lenArr + 68)
-    arr2[0:20] = key[0:20]
-    arr2 = XOR64Buffer(arr2, 0x36)
-    arr2[64 : 64 + lenArr] = arr
-    arr2[lenArr + 67] = i & 0xFF
-    i = i >> 8
-    arr2[lenArr + 66] = i & 0xFF
-    i = i >> 8
-    arr2[lenArr + 65] = i & 0xFF
-    i = i >> 8
-    arr2[lenArr + 64] = i & 0xFF
-    arr2sha1 = hashlib.sha1(arr2).digest()
-    arr3 = bytearray(84)
-    arr3[0:20] = key[0:20]
-    arr3 = XOR64Buffer(arr3, 0x5C)
-    arr3[64 : 64 + len(arr2sha1)] = arr2sha1
-    arr3sha1 = hashlib.sha1(arr3).digest()
-    return generatePswV2(arr3sha1)
-
-
-def getCheckSum(arr, i1, i2):
-    c = 0
-    for i in range(i1, i2):
-        c = c + arr[i]
-    return c & 0xFF
+    msg = bytes(arr) + (i & 0xFFFFFFFF).to_bytes(4, "big")
+    return generatePswV2(hmac.new(bytes(key[0:20]), msg, hashlib.sha1).digest())
 
 
 class AirbnkCodesGenerator:
     manufactureKey = ""
     bindingkey = ""
     systemTime = 0
+    _manKeyCipher = None
+    _workingKey = None
 
     def __init__(self):
         return
@@ -121,7 +84,7 @@ class AirbnkCodesGenerator:
         if lock_dir != 1 and lock_dir != 2:
             return None
 
-        self.systemTime = int(round(time.time()))
+        self.systemTime = int(time.time())
         # self.systemTime = 1637590376
         opCode = self.makePackageV3(lock_dir, self.systemTime, curr_lockEvents)
         _LOGGER.debug("OperationCode for dir %s is %s", lock_dir, opCode)
@@ -143,17 +106,15 @@ class AirbnkCodesGenerator:
         code[10] = tStamp & 0xFF
         tStamp = tStamp >> 8
         code[9] = tStamp & 0xFF
-        toEncrypt = code[4:18]
-        manKey = self.manufacturerKey[0:16]
-        encrypted = AESCipher(manKey).encrypt(toEncrypt, False)
-        code[4:20] = encrypted
-        workingKey = generateWorkingKey(self.bindingKey, 0)
-        signature = generateSignatureV2(workingKey, curr_lockEvents, code[3:20])
+        # code[4:18] is PKCS7-padded in place to a single 16-byte block
+        code[18] = code[19] = 2
+        code[4:20] = self._manKeyCipher.encrypt_block16(code[4:20])
+        signature = generateSignatureV2(self._workingKey, curr_lockEvents, code[3:20])
         # print("Working Key is {} {} {}".format(workingKey, lockEvents, code[3:20]))
         # print("Signature is {}".format(signature))
         code[20 : 20 + len(signature)] = signature
-        code[20 + len(signature)] = getCheckSum(code, 3, 28)
-        return binascii.hexlify(code).upper()
+        code[20 + len(signature)] = sum(code[3:28]) & 0xFF
+        return code.hex().upper()
         # return code
 
     def decryptKeys(self, newSnInfo, appKey):
@@ -165,13 +126,16 @@ class AirbnkCodesGenerator:
         lockSn = dec[0:16].decode("utf-8").rstrip("\x00")
         decr_json["lockSn"] = lockSn
         decr_json["lockModel"] = dec[80:88].decode("utf-8").rstrip("\x00")
-        manKeyEncrypted = dec[16:48]
-        bindKeyEncrypted = dec[48:80]
+        # manufacturer key (16:48) and binding key (48:80) share the same key
+        keysEncrypted = dec[16:80]
         toHash = bytes(lockSn + appKey, "utf-8")
         hash_object = hashlib.sha1()
         hash_object.update(toHash)
         jdkSHA1 = hash_object.hexdigest()
         key2 = bytes.fromhex(jdkSHA1[0:32])
-        self.manufacturerKey = AESCipher(key2).decrypt(manKeyEncrypted, False)
-        self.bindingKey = AESCipher(key2).decrypt(bindKeyEncrypted, False)
+        self.manufacturerKey, self.bindingKey = AESCipher(key2).decrypt_chunks(
+            keysEncrypted, 32
+        )
+        self._manKeyCipher = AESCipher(self.manufacturerKey[0:16])
+        self._workingKey = generateWorkingKey(self.bindingKey, 0)
         return decr_json
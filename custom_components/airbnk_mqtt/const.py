@@ -54,6 +54,20 @@ LOCK_STATE_STRINGS = {
     LOCK_STATE_FAILED: "Failed",
 }
 
+# Lock state indexed by the 3-bit state field of type1 locks
+STATE_LUT = (
+    LOCK_STATE_UNLOCKED,
+    LOCK_STATE_LOCKED,
+    LOCK_STATE_JAMMED,
+    LOCK_STATE_JAMMED,
+    LOCK_STATE_LOCKED,
+    LOCK_STATE_UNLOCKED,
+    LOCK_STATE_JAMMED,
+    LOCK_STATE_JAMMED,
+)
+# Each byte value decoded into its 8 bits, least significant first
+FLAG_TABLE = tuple(tuple((b >> n) & 1 != 0 for n in range(8)) for b in range(256))
+
 SENSOR_TYPE_STATE = "state"
 SENSOR_TYPE_BATTERY = "battery"
 SENSOR_TYPE_VOLTAGE = "voltage"
@@ -1,8 +1,14 @@
 from __future__ import annotations
 import json
+import struct
 import time
 from typing import Callable
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 from homeassistant.helpers.device_registry import CONNECTION_NETWORK_MAC
 from homeassistant.components import mqtt
 from homeassistant.core import HomeAssistant, callback
@@ -21,6 +27,7 @@ from .const import (
     LOCK_STATE_OPERATING,
     LOCK_STATE_FAILED,
     LOCK_STATE_STRINGS,
+    FLAG_TABLE,
     CONF_MAC_ADDRESS,
     CONF_MQTT_TOPIC,
     CONF_VOLTAGE_THRESHOLDS,
@@ -41,44 +48,41 @@ BLEOperationReportTopic = "%s/command_result"
 
 
 class CustomMqttLockDevice:
-
-    utcMinutes = None
-    voltage = None
-    isBackLock = None
-    isInit = None
-    isImageA = None
-    isHadNewRecord = None
-    curr_state = LOCK_STATE_UNLOCKED
-    softVersion = None
-    isEnableAuto = None
-    opensClockwise = None
-    isLowBattery = None
-    magnetcurr_state = None
-    isMagnetEnable = None
-    isBABA = None
-    lversionOfSoft = None
-    versionOfSoft = None
-    versionCode = None
-    serialnumber = None
-    lockEvents = 0
-    _lockConfig = {}
-    _lockData = {}
-    _codes_generator = None
-    cmd = {}
-    cmdSent = False
-    last_advert_time = 0
-    last_telemetry_time = 0
-    is_available = False
-    retries_num = DEFAULT_RETRIES_NUM
-    curr_try = 0
-
     def __init__(self, hass: HomeAssistant, device_config, entry_options):
         self.logger = AirbnkLogger(__name__)
         self.logger.debug(
             "Setting up CustomMqttLockDevice for sn %s" % device_config["sn"]
         )
         self.hass = hass
+        self.utcMinutes = None
+        self.voltage = None
+        self.isBackLock = None
+        self.isInit = None
+        self.isImageA = None
+        self.isHadNewRecord = None
+        self.curr_state = LOCK_STATE_UNLOCKED
+        self.softVersion = None
+        self.isEnableAuto = None
+        self.opensClockwise = None
+        self.isLowBattery = None
+        self.magnetcurr_state = None
+        self.isMagnetEnable = None
+        self.isBABA = None
+        self.boardModel = None
+        self.lversionOfSoft = None
+        self.versionOfSoft = None
+        self.versionCode = None
+        self.serialnumber = None
+        self.lockEvents = 0
+        self.cmd = {}
+        self.cmdSent = False
+        self.last_advert_time = 0
+        self.last_telemetry_time = 0
+        self.is_available = False
+        self.retries_num = DEFAULT_RETRIES_NUM
+        self.curr_try = 0
         self._callbacks = set()
+        self._callbacks_tuple = ()
         self._unsubscribe_callbacks = set()
         self._lockConfig = device_config
         self._codes_generator = AirbnkCodesGenerator()
@@ -107,7 +111,7 @@ class CustomMqttLockDevice:
         }
 
     def check_availability(self):
-        curr_time = int(round(time.time()))
+        curr_time = time.monotonic_ns() // 1_000_000_000
         deltatime1 = curr_time - self.last_advert_time
         deltatime2 = curr_time - self.last_telemetry_time
         # self.logger.debug(
@@ -156,21 +160,22 @@ class CustomMqttLockDevice:
             return
 
         @callback
-        async def adv_received(_p0) -> None:
+        def adv_received(_p0) -> None:
             self.parse_adv_message(_p0.payload)
 
         @callback
-        async def operation_msg_received(_p0) -> None:
+        def operation_msg_received(_p0) -> None:
             self.parse_operation_message(_p0.payload)
 
         @callback
-        async def telemetry_msg_received(_p0) -> None:
+        def telemetry_msg_received(_p0) -> None:
             self.parse_telemetry_message(_p0.payload)
 
         callback_func = await mqtt.async_subscribe(
             self.hass,
             BLEStateTopic % self._lockConfig[CONF_MQTT_TOPIC],
             msg_callback=adv_received,
+            encoding=None,
         )
         self._unsubscribe_callbacks.add(callback_func)
 
@@ -178,6 +183,7 @@ class CustomMqttLockDevice:
             self.hass,
             BLETelemetryTopic % self._lockConfig[CONF_MQTT_TOPIC],
             msg_callback=telemetry_msg_received,
+            encoding=None,
         )
         self._unsubscribe_callbacks.add(callback_func)
 
@@ -185,6 +191,7 @@ class CustomMqttLockDevice:
             self.hass,
             BLEOperationReportTopic % self._lockConfig[CONF_MQTT_TOPIC],
             msg_callback=operation_msg_received,
+            encoding=None,
         )
         self._unsubscribe_callbacks.add(callback_func)
 
@@ -195,16 +202,22 @@ class CustomMqttLockDevice:
     def register_callback(self, callback: Callable[[], None]) -> None:
         """Register callback, called when lock changes state."""
         self._callbacks.add(callback)
+        self._callbacks_tuple = tuple(self._callbacks)
+
+    def unregister_callback(self, callback: Callable[[], None]) -> None:
+        """Remove previously registered callback."""
+        self._callbacks.discard(callback)
+        self._callbacks_tuple = tuple(self._callbacks)
 
     def parse_telemetry_message(self, msg):
         # TODO
         self.logger.debug("Received telemetry %s" % msg)
-        self.last_telemetry_time = int(round(time.time()))
+        self.last_telemetry_time = time.monotonic_ns() // 1_000_000_000
         self.is_available = True
 
     def parse_adv_message(self, msg):
         self.logger.debug("Received adv %s" % msg)
-        payload = json.loads(msg)
+        payload = json_loads(msg)
         mac_address = self._lockConfig[CONF_MAC_ADDRESS]
         mqtt_advert = payload["data"]
         mqtt_mac = payload["mac"].replace(":", "").upper()
@@ -214,7 +227,7 @@ class CustomMqttLockDevice:
 
         self.parse_MQTT_advert(mqtt_advert.upper())
         time2 = self.last_advert_time
-        self.last_advert_time = int(round(time.time()))
+        self.last_advert_time = time.monotonic_ns() // 1_000_000_000
         if "rssi" in payload:
             rssi = payload["rssi"]
             self._lockData[SENSOR_TYPE_SIGNAL_STRENGTH] = rssi
@@ -224,12 +237,12 @@ class CustomMqttLockDevice:
         self.is_available = True
         self.logger.debug("Time from last message: %s secs" % str(deltatime))
 
-        for callback_func in self._callbacks:
+        for callback_func in self._callbacks_tuple:
             callback_func()
 
     def parse_operation_message(self, msg):
         self.logger.debug("Received operation result %s" % msg)
-        payload = json.loads(msg)
+        payload = json_loads(msg)
         mac_address = self._lockConfig[CONF_MAC_ADDRESS]
         mqtt_mac = payload["mac"].replace(":", "").upper()
 
@@ -243,13 +256,13 @@ class CustomMqttLockDevice:
                 time.sleep(0.5)
                 self.logger.debug("Retrying: attempt %i" % self.curr_try)
                 self.curr_state = LOCK_STATE_OPERATING
-                for callback_func in self._callbacks:
+                for callback_func in self._callbacks_tuple:
                     callback_func()
                 self.send_mqtt_command()
             else:
                 self.logger.error("No more retries: command FAILED")
                 self.curr_state = LOCK_STATE_FAILED
-                for callback_func in self._callbacks:
+                for callback_func in self._callbacks_tuple:
                     callback_func()
                 raise Exception("Failed sending command: returned %s", msg_state)
             return
@@ -260,7 +273,7 @@ class CustomMqttLockDevice:
 
         self.parse_new_lockStatus(payload["lockStatus"])
 
-        for callback_func in self._callbacks:
+        for callback_func in self._callbacks_tuple:
             callback_func()
 
     async def operateLock(self, lock_dir):
@@ -268,13 +281,13 @@ class CustomMqttLockDevice:
         self.curr_state = LOCK_STATE_OPERATING
         self.curr_try = 0
         self.cmdSent = False
-        for callback_func in self._callbacks:
+        for callback_func in self._callbacks_tuple:
             callback_func()
 
         opCode = self._codes_generator.generateOperationCode(lock_dir, self.lockEvents)
         self.cmd = {}
-        self.cmd["command1"] = "FF00" + opCode[0:36].decode("utf-8")
-        self.cmd["command2"] = "FF01" + opCode[36:].decode("utf-8")
+        self.cmd["command1"] = "FF00" + opCode[0:36]
+        self.cmd["command2"] = "FF01" + opCode[36:]
         self.cmd["sign"] = self._codes_generator.systemTime
         self.send_mqtt_command()
 
@@ -296,22 +309,22 @@ class CustomMqttLockDevice:
                 time.sleep(0.5)
                 self.logger.debug("Retrying: attempt %i" % self.curr_try)
                 self.curr_state = LOCK_STATE_OPERATING
-                for callback_func in self._callbacks:
+                for callback_func in self._callbacks_tuple:
                     callback_func()
                 self.send_mqtt_command()
             else:
                 self.logger.error("No more retries: command FAILED")
                 self.curr_state = LOCK_STATE_FAILED
-                for callback_func in self._callbacks:
+                for callback_func in self._callbacks_tuple:
                     callback_func()
                 raise Exception(
                     "Failed sending command: received status %s", lockStatus
                 )
             return
 
-        lockEvents = (bArr[10] << 24) | (bArr[11] << 16) | (bArr[12] << 8) | bArr[13]
+        lockEvents, voltage_raw = struct.unpack_from(">IH", bArr, 10)
         self.lockEvents = lockEvents
-        self.voltage = ((float)((bArr[14] << 8) | bArr[15])) * 0.01
+        self.voltage = float(voltage_raw) * 0.01
         self.curr_state = (bArr[16] >> 4) & 3
 
     def parse_MQTT_advert(self, mqtt_advert):
@@ -321,38 +334,45 @@ class CustomMqttLockDevice:
             self.logger.error("Wrong advert msg: %s" % mqtt_advert)
             return
 
-        self.voltage = ((float)((bArr[16] << 8) | bArr[17])) * 0.01
-        self.boardModel = bArr[2]
-        self.lversionOfSoft = bArr[3]
-        self.sversionOfSoft = (bArr[4] << 16) | (bArr[5] << 8) | bArr[6]
-        serialnumber = bArr[7:16].decode("utf-8").strip("\0")
+        (
+            self.boardModel,
+            self.lversionOfSoft,
+            sversion_hi,
+            sversion_lo,
+            sn_raw,
+            voltage_raw,
+            lockEvents,
+            flags1,
+            flags2,
+        ) = struct.unpack_from(">BBBH9sHIBB", bArr, 2)
+        self.voltage = float(voltage_raw) * 0.01
+        self.sversionOfSoft = (sversion_hi << 16) | sversion_lo
+        serialnumber = sn_raw.decode("utf-8").strip("\0")
         if serialnumber != self._lockConfig["sn"]:
             self.logger.error(
                 "ERROR: s/n in advert (%s) is different from cloud data (%s)"
                 % (serialnumber, self._lockConfig["sn"])
             )
 
-        lockEvents = (bArr[18] << 24) | (bArr[19] << 16) | (bArr[20] << 8) | bArr[21]
-        new_state = (bArr[22] >> 4) & 3
-        self.opensClockwise = (bArr[22] & 0x80) != 0
+        new_state = (flags1 >> 4) & 3
+        (
+            self.isBackLock,
+            self.isInit,
+            self.isImageA,
+            self.isHadNewRecord,
+            _,
+            _,
+            self.isEnableAuto,
+            self.opensClockwise,
+        ) = FLAG_TABLE[flags1]
         if self.curr_state < LOCK_STATE_OPERATING or self.lockEvents != lockEvents:
             self.lockEvents = lockEvents
             self.curr_state = new_state
             if self.opensClockwise and self.curr_state is not LOCK_STATE_JAMMED:
                 self.curr_state = 1 - self.curr_state
 
-        z = False
-        self.isBackLock = (bArr[22] & 1) != 0
-        self.isInit = (2 & bArr[22]) != 0
-        self.isImageA = (bArr[22] & 4) != 0
-        self.isHadNewRecord = (bArr[22] & 8) != 0
-        self.isEnableAuto = (bArr[22] & 0x40) != 0
-        self.isLowBattery = (bArr[23] & 0x10) != 0
-        self.magnetcurr_state = (bArr[23] >> 5) & 3
-        if (bArr[23] & 0x80) != 0:
-            z = True
-
-        self.isMagnetEnable = z
+        _, _, _, _, self.isLowBattery, _, _, self.isMagnetEnable = FLAG_TABLE[flags2]
+        self.magnetcurr_state = (flags2 >> 5) & 3
         self.isBABA = True
 
         self.battery_perc = self.calculate_battery_percentage(self.voltage)
@@ -1,11 +1,12 @@
 from __future__ import annotations
-import base64
-import json
+import struct
 import time
 from typing import Callable
 
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 from homeassistant.helpers.device_registry import CONNECTION_NETWORK_MAC
 from homeassistant.components import mqtt
@@ -25,6 +26,8 @@ from .const import (
     LOCK_STATE_OPERATING,
     LOCK_STATE_FAILED,
     LOCK_STATE_STRINGS,
+    STATE_LUT,
+    FLAG_TABLE,
     CONF_MAC_ADDRESS,
     CONF_MQTT_TOPIC,
     CONF_VOLTAGE_THRESHOLDS,
@@ -47,85 +50,60 @@ read_characteristic_UUID = "FFF3"
 service_UUID = "FFF0"
 
 
-class AESCipher:
-    """Cipher module for AES decryption."""
-
-    def __init__(self, key):
-        """Initialize a new AESCipher."""
-        self.block_size = 16
-        self.cipher = Cipher(algorithms.AES(key), modes.ECB(), default_backend())
-
-    def encrypt(self, raw, use_base64=True):
-        """Encrypt data to be sent to device."""
-        encryptor = self.cipher.encryptor()
-        crypted_text = encryptor.update(self._pad(raw)) + encryptor.finalize()
-        return base64.b64encode(crypted_text) if use_base64 else crypted_text
-
-    def decrypt(self, enc, use_base64=True):
-        """Decrypt data from device."""
-        if use_base64:
-            enc = base64.b64decode(enc)
-
-        decryptor = self.cipher.decryptor()
-        return self._unpad(decryptor.update(enc) + decryptor.finalize())
-
-    def _pad(self, data):
-        padnum = self.block_size - len(data) % self.block_size
-        return data + padnum * chr(padnum).encode()
-
-    @staticmethod
-    def _unpad(data):
-        return data[: -ord(data[len(data) - 1 :])]
-
-
 class TasmotaMqttLockDevice:
-
-    utcMinutes = None
-    voltage = None
-    battery_perc = None
-    isBackLock = None
-    isInit = None
-    isImageA = None
-    isHadNewRecord = None
-    curr_state = LOCK_STATE_UNLOCKED
-    softVersion = None
-    isEnableAuto = None
-    opensClockwise = None
-    isLowBattery = None
-    magnetcurr_state = None
-    isMagnetEnable = None
-    isBABA = None
-    lversionOfSoft = None
-    sversionOfSoft = None
-    serialnumber = None
-    lockEvents = 0
-    _lockConfig = {}
-    _lockData = {}
-    _codes_generator = None
-    frame1hex = ""
-    frame2hex = ""
-    frame1sent = False
-    frame2sent = False
-    last_advert_time = 0
-    is_available = False
-    retries_num = DEFAULT_RETRIES_NUM
-    curr_try = 0
-
     def __init__(self, hass: HomeAssistant, device_config, entry_options):
         self.logger = AirbnkLogger(__name__)
         self.logger.debug(
             "Setting up TasmotaMqttLockDevice for sn %s" % device_config["sn"]
         )
         self.hass = hass
+        self.utcMinutes = None
+        self.voltage = None
+        self.battery_perc = None
+        self.isBackLock = None
+        self.isInit = None
+        self.isImageA = None
+        self.isHadNewRecord = None
+        self.curr_state = LOCK_STATE_UNLOCKED
+        self.softVersion = None
+        self.isEnableAuto = None
+        self.opensClockwise = None
+        self.isLowBattery = None
+        self.magnetcurr_state = None
+        self.isMagnetEnable = None
+        self.isBABA = None
+        self.boardModel = None
+        self.lversionOfSoft = None
+        self.sversionOfSoft = None
+        self.serialnumber = None
+        self.lockEvents = 0
+        self.frame1hex = ""
+        self.frame2hex = ""
+        self.frame1sent = False
+        self.frame2sent = False
+        self._write_prefix = ""
+        self.last_advert_time = 0
+        self.is_available = False
+        self.retries_num = DEFAULT_RETRIES_NUM
+        self.curr_try = 0
         self._callbacks = set()
+        self._callbacks_tuple = ()
         self._unsubscribe_callbacks = set()
         self._lockConfig = device_config
         self._codes_generator = AirbnkCodesGenerator()
         self._lockData = self._codes_generator.decryptKeys(
             device_config["newSninfo"], device_config["appKey"]
         )
+        self._sn_bytes = self._lockData["lockSn"].encode("utf-8")
+        mqtt_topic = self._lockConfig[CONF_MQTT_TOPIC]
+        self._bleop_topic = BLEOpTopic % mqtt_topic
+        self._blerule1_topic = BLERule1Topic % mqtt_topic
+        self._bledetails_topic = BLEDetailsTopic % mqtt_topic
+        self._bledetailsall_topic = BLEDetailsAllTopic % mqtt_topic
+        self._blestate_topic = BLEStateTopic % mqtt_topic
         self.set_options(entry_options)
         mac_address = self._lockConfig[CONF_MAC_ADDRESS]
+        self.set_write_prefix(mac_address)
         if mac_address is not None and mac_address != "":
             self.requestDetails(mac_address)
         else:
@@ -150,7 +128,7 @@ class TasmotaMqttLockDevice:
         }
 
     def check_availability(self):
-        curr_time = int(round(time.time()))
+        curr_time = time.monotonic_ns() // 1_000_000_000
         deltatime = curr_time - self.last_advert_time
         # self.logger.debug("Last reply was %s secs ago" % deltatime)
         if deltatime >= MAX_NORECEIVE_TIME:
@@ -195,13 +173,14 @@ class TasmotaMqttLockDevice:
             return
 
         @callback
-        async def message_received(_p0) -> None:
-            await self.async_parse_MQTT_message(_p0.payload)
+        def message_received(_p0) -> None:
+            self.parse_MQTT_message(_p0.payload)
 
         callback_func = await mqtt.async_subscribe(
             self.hass,
-            BLEStateTopic % self._lockConfig[CONF_MQTT_TOPIC],
+            self._blestate_topic,
             msg_callback=message_received,
+            encoding=None,
         )
         self._unsubscribe_callbacks.add(callback_func)
 
@@ -212,6 +191,12 @@ class TasmotaMqttLockDevice:
     def register_callback(self, callback: Callable[[], None]) -> None:
         """Register callback, called when lock changes state."""
         self._callbacks.add(callback)
+        self._callbacks_tuple = tuple(self._callbacks)
+
+    def unregister_callback(self, callback: Callable[[], None]) -> None:
+        """Remove previously registered callback."""
+        self._callbacks.discard(callback)
+        self._callbacks_tuple = tuple(self._callbacks)
 
     def parse_from_fff3_read_prop(self, sn, barr=[0]):
         # Initialising empty Lockeradvertising variables
@@ -227,30 +212,37 @@ class TasmotaMqttLockDevice:
             else:
                 self.type2(barr, sn)
 
-    async def async_parse_MQTT_message(self, msg):
+    def parse_MQTT_message(self, msg):
         self.logger.debug("Received msg %s" % msg)
-        payload = json.loads(msg)
+        payload = json_loads(msg)
         msg_type = list(payload.keys())[0]
+        msg_data = payload[msg_type]
         mac_address = self._lockConfig[CONF_MAC_ADDRESS]
-        if "details" in msg_type.lower() and ("p" and "mac" in payload[msg_type]):
-            mqtt_advert = payload[msg_type]["p"]
-            mqtt_mac = payload[msg_type]["mac"]
+        if "details" in msg_type.lower() and "p" in msg_data and "mac" in msg_data:
+            mqtt_advert = msg_data["p"]
+            mqtt_mac = msg_data["mac"]
+            advert = None
             if mac_address is None or mac_address == "":
-                sn_hex = "".join(
-                    "{:02x}".format(ord(c)) for c in self._lockData["lockSn"]
-                )
-                if mqtt_advert[24 : 24 + len(sn_hex)] != sn_hex:
+                advert = self.decode_advert(mqtt_advert)
+                sn_bytes = self._sn_bytes
+                if advert is None or advert[12 : 12 + len(sn_bytes)] != sn_bytes:
                     return
                 self._lockConfig[CONF_MAC_ADDRESS] = mqtt_mac
                 mac_address = mqtt_mac
+                self.set_write_prefix(mac_address)
                 self.requestDetails(mqtt_mac)
 
             if mqtt_mac == mac_address and len(mqtt_advert) == 62:
-                self.parse_MQTT_advert(mqtt_advert[10:])
+                if advert is None:
+                    advert = self.decode_advert(mqtt_advert)
+                if advert is None:
+                    self.logger.error("Wrong advert msg: %s" % mqtt_advert)
+                    return
+                self.parse_MQTT_advert(advert[5:])
                 time2 = self.last_advert_time
-                self.last_advert_time = int(round(time.time()))
-                if "RSSI" in payload[msg_type]:
-                    rssi = payload[msg_type]["RSSI"]
+                self.last_advert_time = time.monotonic_ns() // 1_000_000_000
+                if "RSSI" in msg_data:
+                    rssi = msg_data["RSSI"]
                     self._lockData[SENSOR_TYPE_SIGNAL_STRENGTH] = rssi
 
                 deltatime = self.last_advert_time - time2
@@ -267,14 +259,28 @@ class TasmotaMqttLockDevice:
                     )
                     self.is_available = False
 
-                for callback_func in self._callbacks:
+                for callback_func in self._callbacks_tuple:
                     callback_func()
 
-        if "operation" in msg_type.lower() and ("state" and "MAC" in payload[msg_type]):
-            if payload[msg_type]["MAC"] != mac_address:
+        if (
+            "operation" in msg_type.lower()
+            and "state" in msg_data
+            and "MAC" in msg_data
+        ):
+            if msg_data["MAC"] != mac_address:
                 return
-            msg_state = payload[msg_type]["state"]
+            msg_state = msg_data["state"]
             if "FAIL" in msg_state:
+                if (
+                    not self.frame1sent
+                    and msg_data.get("write") == self.frame2hex.upper()
+                ):
+                    # Tasmota BLEOp reports echo the written payload in "write":
+                    # this is the frame2 queued right after the failed frame1,
+                    # and the retry of frame1 already resends it. Reports
+                    # without "write" fall through to a normal retry.
+                    return
+
                 self.logger.error("Failed sending frame: returned %s" % msg_state)
 
                 if self.curr_try < self.retries_num:
@@ -282,29 +288,32 @@ class TasmotaMqttLockDevice:
                     time.sleep(0.5)
                     self.logger.debug("Retrying: attempt %i" % self.curr_try)
                     self.curr_state = LOCK_STATE_OPERATING
-                    for callback_func in self._callbacks:
+                    for callback_func in self._callbacks_tuple:
                         callback_func()
                     if self.frame1sent:
-                        await self.async_sendFrame2()
+                        self.sendFrame2()
                     else:
-                        await self.async_sendFrame1()
+                        self.sendFrames()
                 else:
                     self.logger.error("No more retries: command FAILED")
                     self.curr_state = LOCK_STATE_FAILED
-                    for callback_func in self._callbacks:
+                    for callback_func in self._callbacks_tuple:
                         callback_func()
                     raise Exception("Failed sending frame: returned %s", msg_state)
 
                 return
 
-            msg_written_payload = payload[msg_type]["write"]
+            msg_written_payload = msg_data["write"]
             if msg_written_payload == self.frame1hex.upper():
                 self.frame1sent = True
-                await self.async_sendFrame2()
 
             if msg_written_payload == self.frame2hex.upper():
+                if not self.frame1sent:
+                    # frame2 of a batch whose frame1 failed: the lock got it
+                    # alone, and the retry resends both frames
+                    return
                 self.frame2sent = True
-                for callback_func in self._callbacks:
+                for callback_func in self._callbacks_tuple:
                     callback_func()
 
     async def operateLock(self, lock_dir):
@@ -315,49 +324,54 @@ class TasmotaMqttLockDevice:
         self.curr_try = 0
         self.frame1sent = False
         self.frame2sent = False
-        for callback_func in self._callbacks:
+        for callback_func in self._callbacks_tuple:
             callback_func()
 
         opCode = self._codes_generator.generateOperationCode(lock_dir, self.lockEvents)
-        self.frame1hex = "FF00" + opCode[0:36].decode("utf-8")
-        self.frame2hex = "FF01" + opCode[36:].decode("utf-8")
+        self.frame1hex = "FF00" + opCode[0:36]
+        self.frame2hex = "FF01" + opCode[36:]
 
-        await self.async_sendFrame1()
+        self.sendFrames()
 
     def requestDetails(self, mac_addr):
         mqtt.publish(
             self.hass,
-            BLERule1Topic % self._lockConfig[CONF_MQTT_TOPIC],
+            self._blerule1_topic,
             "ON Mqtt#Connected DO BLEDetails2 %s ENDON" % mac_addr,
         )
-        mqtt.publish(self.hass, BLERule1Topic % self._lockConfig[CONF_MQTT_TOPIC], "1")
-        mqtt.publish(
-            self.hass, BLEDetailsTopic % self._lockConfig[CONF_MQTT_TOPIC], mac_addr
-        )
+        mqtt.publish(self.hass, self._blerule1_topic, "1")
+        mqtt.publish(self.hass, self._bledetails_topic, mac_addr)
 
     def scanAllAdverts(self):
-        mqtt.publish(
-            self.hass, BLEDetailsAllTopic % self._lockConfig[CONF_MQTT_TOPIC], ""
-        )
+        mqtt.publish(self.hass, self._bledetailsall_topic, "")
 
-    async def async_sendFrame1(self):
+    def sendFrames(self):
+        # BLEOp commands are queued by Tasmota, so frame2 does not need to
+        # wait for the write confirmation of frame1
+        self.sendFrame1()
+        self.sendFrame2()
+
+    def sendFrame1(self):
         mqtt.publish(
             self.hass,
-            BLEOpTopic % self._lockConfig[CONF_MQTT_TOPIC],
+            self._bleop_topic,
             self.BLEOPWritePAYLOADGen(self.frame1hex),
         )
 
-    async def async_sendFrame2(self):
+    def sendFrame2(self):
         mqtt.publish(
             self.hass,
-            BLEOpTopic % self._lockConfig[CONF_MQTT_TOPIC],
+            self._bleop_topic,
             self.BLEOPWritePAYLOADGen(self.frame2hex),
         )
 
+    def set_write_prefix(self, mac_address):
+        self._write_prefix = (
+            f"M:{mac_address} s:{service_UUID} c:{write_characteristic_UUID} w:"
+        )
+
     def BLEOPWritePAYLOADGen(self, frame):
-        mac_address = self._lockConfig[CONF_MAC_ADDRESS]
-        write_UUID = write_characteristic_UUID
-        payload = f"M:{mac_address} s:{service_UUID} c:{write_UUID} w:{frame} go"
+        payload = f"{self._write_prefix}{frame} go"
         self.logger.debug("Sending payload [ %s ]" % payload)
         return payload
 
@@ -367,100 +381,71 @@ class TasmotaMqttLockDevice:
 
     def type1(self, barr, sn):
         self.serialnumber = sn
-        self.lockEvents = (
-            (barr[10] << 24) | (barr[11] << 16) | (barr[12] << 8) | barr[13]
-        )
-        self.voltage = ((((barr[14] & 255) << 8) | (barr[15] & 255))) * 0.01
-        magnetenableindex = False
-        self.isBackLock = (barr[16] & 1) != 0
-        self.isInit = (barr[16] & 2) != 0
-        self.isImageA = (barr[16] & 4) != 0
-        self.isHadNewRecord = (barr[16] & 8) != 0
-        i = ((barr[16] & 255) >> 4) & 7
-
-        if i == 0 or i == 5:
-            self.curr_state = LOCK_STATE_UNLOCKED
-        elif i == 1 or i == 4:
-            self.curr_state = LOCK_STATE_LOCKED
-        else:
-            self.curr_state = LOCK_STATE_JAMMED
+        self.lockEvents, voltage_raw = struct.unpack_from(">IH", barr, 10)
+        self.voltage = voltage_raw * 0.01
+        (
+            self.isBackLock,
+            self.isInit,
+            self.isImageA,
+            self.isHadNewRecord,
+            _,
+            _,
+            opensCounterClockwise,
+            self.isEnableAuto,
+        ) = FLAG_TABLE[barr[16]]
+        self.curr_state = STATE_LUT[(barr[16] >> 4) & 7]
 
         self.softVersion = (
             (str(int(barr[7]))) + "." + (str(int(barr[8]))) + "." + (str(int(barr[9])))
         )
-        self.isEnableAuto = (barr[16] & 128) != 0
-        self.opensClockwise = (barr[16] & 64) == 0
-        self.isLowBattery = (16 & barr[17]) != 0
+        self.opensClockwise = not opensCounterClockwise
+        _, _, _, _, self.isLowBattery, _, _, self.isMagnetEnable = FLAG_TABLE[barr[17]]
         self.magnetcurr_state = (barr[17] >> 5) & 3
-        if (barr[17] & 128) != 0:
-            magnetenableindex = True
-
-        self.isMagnetEnable = magnetenableindex
         self.isBABA = True
         self.parse1(barr, sn)
 
     # Function used to set properties type2 lock
     def type2(self, barr, sn):
         self.serialnumber = sn
-        self.lockEvents = (
-            ((barr[8] & 255) << 24)
-            | ((barr[9] & 255) << 16)
-            | ((barr[10] & 255) << 8)
-            | (barr[11] & 255)
-        )
-        self.utcMinutes = (
-            ((barr[12] & 255) << 24)
-            | ((barr[13] & 255) << 16)
-            | ((barr[14] & 255) << 8)
-            | (barr[15] & 255)
-        )
+        self.lockEvents, self.utcMinutes = struct.unpack_from(">II", barr, 8)
         self.voltage = ((barr[16] & 255)) * 0.1
-        index = True
-        self.isBackLock = (barr[17] & 1) != 0
-        self.isInit = (barr[17] & 2) != 0
-        self.isImageA = (barr[17] & 4) != 0
-        self.isHadNewRecord = (8 & barr[17]) != 0
-        self.curr_state = ((barr[17] & 255) >> 4) & 3
-        self.isEnableAuto = (barr[17] & 64) != 0
-        if (barr[17] & 128) == 0:
-            index = False
-
-        self.opensClockwise = index
+        (
+            self.isBackLock,
+            self.isInit,
+            self.isImageA,
+            self.isHadNewRecord,
+            _,
+            _,
+            self.isEnableAuto,
+            self.opensClockwise,
+        ) = FLAG_TABLE[barr[17]]
+        self.curr_state = (barr[17] >> 4) & 3
         self.isBABA = False
         self.parse2(barr, sn)
 
     def parse2(self, barr, sn):
         if barr is None:
             return None
+        if len(barr) < 19:
+            raise IndexError("parse2 needs 19 bytes, got %i" % len(barr))
 
         barr2 = bytearray(23)
         barr2[0] = 173
         barr2[1] = barr[6]
         barr2[2] = barr[7]
-        if sn is not None and len(sn) > 0:
-            length = len(sn)
-            bytes1 = bytes(sn, "utf-8")
-            for i in range(length):
-
-                barr2[i + 3] = bytes1[i]
-
-        barr2[12] = barr[8]
-        barr2[13] = barr[9]
-        barr2[14] = barr[10]
-        barr2[15] = barr[11]
-        barr2[16] = barr[12]
-        barr2[17] = barr[13]
-        barr2[18] = barr[14]
-        barr2[19] = barr[15]
-        barr2[20] = barr[16]
-        barr2[21] = barr[17]
-        barr2[22] = barr[18]
+        if sn:
+            bytes1 = sn.encode("utf-8")[0:9]
+            barr2[3 : 3 + len(bytes1)] = bytes1
+
+        barr2[12:23] = barr[8:19]
 
         return bytearray.hex(barr2)
 
     def parse1(self, barr, sn):
         if barr is None:
             return None
+        if len(barr) < 18:
+            raise IndexError("parse1 needs 18 bytes, got %i" % len(barr))
 
         barr2 = bytearray(24)
         barr2[0] = 186
@@ -468,62 +453,67 @@ class TasmotaMqttLockDevice:
         barr2[4] = barr[7]
         barr2[5] = barr[8]
         barr2[6] = barr[9]
-        if sn is not None and len(sn) > 0:
-            length = len(sn)
-            bytes1 = bytes(sn, "utf-8")
-            for i in range(length):
-                barr2[i + 7] = bytes1[i]
-
-        barr2[16] = barr[14]
-        barr2[17] = barr[15]
-        barr2[18] = barr[10]
-        barr2[19] = barr[11]
-        barr2[20] = barr[12]
-        barr2[21] = barr[13]
-        barr2[22] = barr[16]
-        barr2[23] = barr[17]
+        if sn:
+            bytes1 = sn.encode("utf-8")[0:9]
+            barr2[7 : 7 + len(bytes1)] = bytes1
+
+        barr2[16:18] = barr[14:16]
+        barr2[18:22] = barr[10:14]
+        barr2[22:24] = barr[16:18]
 
         return bytearray.hex(barr2)
 
-    def parse_MQTT_advert(self, mqtt_advert):
+    @staticmethod
+    def decode_advert(mqtt_advert):
+        try:
+            return bytes.fromhex(mqtt_advert)
+        except (TypeError, ValueError):
+            return None
 
-        bArr = bytearray.fromhex(mqtt_advert)
+    def parse_MQTT_advert(self, bArr):
         if bArr[0] != 0xBA or bArr[1] != 0xBA:
-            self.logger.error("Wrong advert msg: %s" % mqtt_advert)
+            self.logger.error("Wrong advert msg: %s" % bArr.hex())
             return
 
-        self.voltage = ((float)((bArr[16] << 8) | bArr[17])) * 0.01
-        self.boardModel = bArr[2]
-        self.lversionOfSoft = bArr[3]
-        self.sversionOfSoft = (bArr[4] << 16) | (bArr[5] << 8) | bArr[6]
-        serialnumber = bArr[7:16].decode("utf-8").strip("\0")
+        (
+            self.boardModel,
+            self.lversionOfSoft,
+            sversion_hi,
+            sversion_lo,
+            sn_raw,
+            voltage_raw,
+            lockEvents,
+            flags1,
+            flags2,
+        ) = struct.unpack_from(">BBBH9sHIBB", bArr, 2)
+        self.voltage = float(voltage_raw) * 0.01
+        self.sversionOfSoft = (sversion_hi << 16) | sversion_lo
+        serialnumber = sn_raw.decode("utf-8").strip("\0")
         if serialnumber != self._lockConfig["sn"]:
             self.logger.error(
                 "ERROR: s/n in advert (%s) is different from cloud data (%s)"
                 % (serialnumber, self._lockConfig["sn"])
             )
 
-        lockEvents = (bArr[18] << 24) | (bArr[19] << 16) | (bArr[20] << 8) | bArr[21]
-        new_state = (bArr[22] >> 4) & 3
-        self.opensClockwise = (bArr[22] & 0x80) != 0
+        new_state = (flags1 >> 4) & 3
+        (
+            self.isBackLock,
+            self.isInit,
+            self.isImageA,
+            self.isHadNewRecord,
+            _,
+            _,
+            self.isEnableAuto,
+            self.opensClockwise,
+        ) = FLAG_TABLE[flags1]
         if self.curr_state < LOCK_STATE_OPERATING or self.lockEvents != lockEvents:
             self.lockEvents = lockEvents
             self.curr_state = new_state
             if self.opensClockwise and self.curr_state is not LOCK_STATE_JAMMED:
                 self.curr_state = 1 - self.curr_state
 
-        z = False
-        self.isBackLock = (bArr[22] & 1) != 0
-        self.isInit = (2 & bArr[22]) != 0
-        self.isImageA = (bArr[22] & 4) != 0
-        self.isHadNewRecord = (bArr[22] & 8) != 0
-        self.isEnableAuto = (bArr[22] & 0x40) != 0
-        self.isLowBattery = (bArr[23] & 0x10) != 0
-        self.magnetcurr_state = (bArr[23] >> 5) & 3
-        if (bArr[23] & 0x80) != 0:
-            z = True
-
-        self.isMagnetEnable = z
+        _, _, _, _, self.isLowBattery, _, _, self.isMagnetEnable = FLAG_TABLE[flags2]
+        self.magnetcurr_state = (flags2 >> 5) & 3
         self.isBABA = True
 
         self.battery_perc = self.calculate_battery_percentage(self.voltage)